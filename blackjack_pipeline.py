@@ -1,12 +1,15 @@
 from __future__ import annotations
 
 import argparse
+import contextlib
 import csv
+import json
 import math
 import os
 import random
 import statistics as stats
-from dataclasses import dataclass
+import struct
+from dataclasses import asdict, dataclass
 from multiprocessing import Pool, cpu_count
 from typing import Dict, List, Tuple
 
@@ -15,6 +18,78 @@ import pandas as pd
 import matplotlib.pyplot as plt
 
 
+# Counter-based random streams
+
+class CounterRNG(random.Random):
+    """
+    random.Random drop-in backed by NumPy's counter-based Philox generator,
+    keyed by (seed, stream index). jump(i) re-keys to stream i in O(1), so
+    shoe or game number i can be regenerated without replaying earlier ones,
+    and work split by index is bit-identical to a serial run.
+    Uniforms are produced in blocks that start small after each jump and double
+    up to BLOCK, so short streams (one CSM round) stay cheap; randrange/uniform/
+    shuffle go through random(), getrandbits/randbytes read raw Philox words,
+    and getstate/setstate/pickle capture the Philox state.
+    """
+    BLOCK = 1024
+    FIRST_BLOCK = 16
+
+    def __init__(self, seed: int, index: int = 0):
+        super().__init__()
+        self.key_seed = seed & 0xFFFF_FFFF_FFFF_FFFF
+        self._bitgen = np.random.Philox(key=np.array([self.key_seed, 0], dtype=np.uint64))
+        self._gen = np.random.Generator(self._bitgen)
+        self._state = self._bitgen.state   # template re-used by jump()
+        self.jump(index)
+
+    def seed(self, *args, **kwargs):
+        pass  # streams are selected by key, not by seeding
+
+    def jump(self, index: int, stream: int = 0):
+        """Re-key to (seed, index); `stream` selects an independent side stream (< 256)."""
+        st = self._state
+        st["state"]["key"][:] = (self.key_seed, index | (stream << 56))
+        st["state"]["counter"][:] = 0
+        st["buffer_pos"] = 4; st["has_uint32"] = 0; st["uinteger"] = 0
+        self._bitgen.state = st
+        self._buf = []; self._block = self.FIRST_BLOCK
+
+    def random(self) -> float:
+        if not self._buf:
+            self._buf = self._gen.random(self._block)[::-1].tolist()
+            self._block = min(2 * self._block, self.BLOCK)
+        return self._buf.pop()
+
+    def getrandbits(self, k: int) -> int:
+        if k < 0: raise ValueError("number of bits must be non-negative")
+        if k == 0: return 0
+        words = (k + 63) // 64
+        return int.from_bytes(self._bitgen.random_raw(words).astype("<u8").tobytes(), "little") >> (64 * words - k)
+
+    def getstate(self):
+        return self.key_seed, self._bitgen.state, list(self._buf), self._block
+
+    def setstate(self, state):
+        self.key_seed, st, buf, self._block = state
+        self._bitgen.state = st; self._buf = list(buf)
+
+    def __reduce__(self):
+        return self.__class__, (self.key_seed,), self.getstate()
+
+    def _randbelow(self, n: int, maxsize: int = 1 << 53) -> int:
+        # same values as Random._randbelow_without_getrandbits, minus its overhead;
+        # ranges too wide for a 53-bit float use getrandbits instead
+        if n >= maxsize: return self._randbelow_with_getrandbits(n)
+        limit = (maxsize - maxsize % n) / maxsize
+        r = self.random()
+        while r >= limit: r = self.random()
+        return int(r * maxsize) % n
+
+def make_rng(seed: int, mode: str = "sequential") -> random.Random:
+    """'sequential' = one Mersenne Twister stream; 'counter' = CounterRNG."""
+    return CounterRNG(seed) if mode == "counter" else random.Random(seed)
+
+
 # Infinite-deck draws used by dataset generator & dealer
 
 RANKS = [2,3,4,5,6,7,8,9,10,'A']
@@ -158,16 +233,22 @@ def mc_ev_stand(total: int, dealer_up, rng: random.Random,
 
 # Dataset generation
 
-def generate_dataset(n_rows: int, seed: int, s17: bool) -> pd.DataFrame:
-    rng = random.Random(seed)
-    rows, game_id = [], 1
+def naive_policy(total: int, soft_aces: int) -> str:
+    soft = soft_aces > 0
+    if soft: return 'H' if total <= 17 else 'S'
+    return 'H' if total <= 16 else 'S'
 
-    def naive_policy(total: int, soft_aces: int) -> str:
-        soft = soft_aces > 0
-        if soft: return 'H' if total <= 17 else 'S'
-        return 'H' if total <= 16 else 'S'
-
-    while len(rows) < n_rows:
+def natural_states(rng: random.Random):
+    """
+    Yield decision states (total, soft_aces, dealer_up, game_id) in the order
+    natural naive play reaches them. Cards for the next state are only drawn
+    when the caller asks for it, so rollouts in between share the same rng.
+    With a CounterRNG every game uses its own stream (seed, game_id).
+    """
+    game_id = 1
+    keyed = isinstance(rng, CounterRNG)
+    while True:
+        if keyed: rng.jump(game_id)
         player = [draw_rank(rng), draw_rank(rng)]
         dealer_up = draw_rank(rng)
         p_total, p_soft = hand_total(player)
@@ -176,31 +257,7 @@ def generate_dataset(n_rows: int, seed: int, s17: bool) -> pd.DataFrame:
             game_id += 1; continue
 
         while True:
-            next_card = draw_rank(rng)
-            t_hit, s_hit = add_card(p_total, p_soft, next_card)
-            d_final = dealer_finish(dealer_up, rng, hit_soft_17=not s17)
-
-            ev_hit_roll = mc_ev_hit_rollout(p_total, p_soft, dealer_up, rng,
-                                            hit_soft_17=not s17, n_rollouts=64)
-            ev_stand_mc = mc_ev_stand(p_total, dealer_up, rng, hit_soft_17=not s17, n_rollouts=64)
-            best_action_rollout = 'H' if ev_hit_roll > ev_stand_mc else 'S'
-
-            rows.append({
-                "score": p_total,
-                "score_dealer": 11 if dealer_up == 'A' else int(dealer_up),
-                "hard": "TRUE" if p_soft == 0 else "FALSE",
-                "score_if_hit": t_hit,
-                "score_fin_dealer": d_final,
-                "game_id": game_id,
-                "hit": outcome(t_hit, d_final),
-                "stand": outcome(p_total, d_final),
-                "double": 2 * outcome(t_hit, d_final),
-                "hard_if_hit": "TRUE" if s_hit == 0 else "FALSE",
-                "ev_hit_rollout": ev_hit_roll,
-                "ev_stand": ev_stand_mc,
-                "best_action_rollout": best_action_rollout
-            })
-            if len(rows) >= n_rows: break
+            yield p_total, p_soft, dealer_up, game_id
 
             act = naive_policy(p_total, p_soft)
             if act == 'S': break
@@ -209,6 +266,74 @@ def generate_dataset(n_rows: int, seed: int, s17: bool) -> pd.DataFrame:
 
         game_id += 1
 
+def decision_row(p_total: int, p_soft: int, dealer_up, game_id: int,
+                 rng: random.Random, s17: bool) -> Dict:
+    """
+    Build one dataset row for a decision state: a one-step HIT/STAND sample
+    plus rollout EVs for HIT (naive continuation) and STAND.
+    """
+    next_card = draw_rank(rng)
+    t_hit, s_hit = add_card(p_total, p_soft, next_card)
+    d_final = dealer_finish(dealer_up, rng, hit_soft_17=not s17)
+
+    ev_hit_roll = mc_ev_hit_rollout(p_total, p_soft, dealer_up, rng,
+                                    hit_soft_17=not s17, n_rollouts=64)
+    ev_stand_mc = mc_ev_stand(p_total, dealer_up, rng, hit_soft_17=not s17, n_rollouts=64)
+    best_action_rollout = 'H' if ev_hit_roll > ev_stand_mc else 'S'
+
+    return {
+        "score": p_total,
+        "score_dealer": 11 if dealer_up == 'A' else int(dealer_up),
+        "hard": "TRUE" if p_soft == 0 else "FALSE",
+        "score_if_hit": t_hit,
+        "score_fin_dealer": d_final,
+        "game_id": game_id,
+        "hit": outcome(t_hit, d_final),
+        "stand": outcome(p_total, d_final),
+        "double": 2 * outcome(t_hit, d_final),
+        "hard_if_hit": "TRUE" if s_hit == 0 else "FALSE",
+        "ev_hit_rollout": ev_hit_roll,
+        "ev_stand": ev_stand_mc,
+        "best_action_rollout": best_action_rollout
+    }
+
+def generate_dataset(n_rows: int, seed: int, s17: bool, rng_mode: str = "sequential") -> pd.DataFrame:
+    rng = make_rng(seed, rng_mode)
+    rows = []
+    for p_total, p_soft, dealer_up, game_id in natural_states(rng):
+        rows.append(decision_row(p_total, p_soft, dealer_up, game_id, rng, s17))
+        if len(rows) >= n_rows: break
+    return pd.DataFrame(rows)
+
+def generate_dataset_stratified(per_cell: int, seed: int, s17: bool,
+                                n_pilot: int = 200_000, rng_mode: str = "sequential") -> pd.DataFrame:
+    """
+    Stratified version of generate_dataset.
+    1. Pilot: walk n_pilot natural decision states (no rollouts) and count
+       how often each (total, soft, upcard) cell is reached.
+    2. Evaluate exactly `per_cell` rollout rows for every reached cell.
+    Each row gets a `weight` = natural cell share * n_rows / per_cell, so
+    weighted means over the dataset reproduce natural-frequency metrics.
+    With rng_mode='counter', row i is evaluated on its own stream.
+    """
+    rng = make_rng(seed, rng_mode)
+    counts: Dict[Tuple[int, bool, object], int] = {}
+    for i, (p_total, p_soft, dealer_up, _) in enumerate(natural_states(rng)):
+        if i >= n_pilot: break
+        key = (p_total, p_soft > 0, dealer_up)
+        counts[key] = counts.get(key, 0) + 1
+
+    n_total = per_cell * len(counts)
+    rows, game_id = [], 1
+    def cell_order(key): return (key[1], key[0], 11 if key[2] == 'A' else key[2])
+    for (p_total, soft, dealer_up), c in sorted(counts.items(), key=lambda kv: cell_order(kv[0])):
+        weight = (c / n_pilot) * n_total / per_cell
+        for _ in range(per_cell):
+            if rng_mode == "counter": rng.jump(game_id, stream=1)
+            row = decision_row(p_total, int(soft), dealer_up, game_id, rng, s17)
+            row["weight"] = weight
+            rows.append(row)
+            game_id += 1
     return pd.DataFrame(rows)
 
 
@@ -222,21 +347,25 @@ def threshold_analysis(df: pd.DataFrame, outdir: str, title_suffix: str = ""):
         - Win%, Draw%, Lose%
         - EV (expected return) for one-step outcomes
         - EV if rollout estimates (hit + naive continuation) are available
+    Rows are weighted by the `weight` column when present (stratified datasets).
     Saves both CSV summaries and plots (bar chart + EV curves).
     """
     os.makedirs(outdir, exist_ok=True)
     thresholds = list(range(2, 22))
     have_roll = ("ev_hit_rollout" in df.columns) and ("ev_stand" in df.columns)
+    wts = df["weight"].to_numpy() if "weight" in df.columns else None
 
     rows = []
     for T in thresholds:
         choose_hit = (df["score"] <= T)
         out_disc = np.where(choose_hit, df["hit"].to_numpy(), df["stand"].to_numpy())
-        win = np.mean(out_disc == 1); draw = np.mean(out_disc == 0); lose = np.mean(out_disc == -1)
-        ev_one = out_disc.mean()
+        win = np.average(out_disc == 1, weights=wts); draw = np.average(out_disc == 0, weights=wts)
+        lose = np.average(out_disc == -1, weights=wts)
+        ev_one = np.average(out_disc, weights=wts)
         if have_roll:
             out_ev = np.where(choose_hit, df["ev_hit_rollout"].to_numpy(), df["ev_stand"].to_numpy())
-            ev_roll = float(np.nanmean(out_ev))
+            ok = ~np.isnan(out_ev)
+            ev_roll = float(np.average(out_ev[ok], weights=None if wts is None else wts[ok]))
         else:
             ev_roll = np.nan
         rows.append({"threshold": T, "n": len(out_disc),
@@ -271,27 +400,35 @@ def analyze_csv(csv_path: str, outdir: str):
       - EV by dealer upcard plot
       - Heatmaps for hard/soft hand decisions
       - Threshold analysis results
-
+    Stratified datasets carry a `weight` column; means are then weighted
+    so they reflect natural state frequencies.
     """
     os.makedirs(outdir, exist_ok=True)
     df = pd.read_csv(csv_path)
 
-    for col in ["score","score_dealer","score_if_hit","score_fin_dealer","hit","stand","double","ev_hit_rollout","ev_stand"]:
+    for col in ["score","score_dealer","score_if_hit","score_fin_dealer","hit","stand","double","ev_hit_rollout","ev_stand","weight"]:
         if col in df.columns: df[col] = pd.to_numeric(df[col], errors="coerce")
     if df["hard"].dtype != object: df["hard"] = df["hard"].map({True: "TRUE", False: "FALSE"})
     df["hard"] = df["hard"].astype(str).str.upper().map({"TRUE":"TRUE","FALSE":"FALSE"})
     df = df.dropna(subset=["score","score_dealer","stand","hit"])
 
-    ev_stand = df["ev_stand"].mean() if "ev_stand" in df.columns else df["stand"].mean()
-    ev_hit_one = df["hit"].mean()
-    ev_hit_roll = df["ev_hit_rollout"].mean() if "ev_hit_rollout" in df.columns else None
+    if "weight" not in df.columns: df["weight"] = 1.0
+    def wmean(series: pd.Series):
+        # NaN-skipping like .mean(): drop missing values together with their weights
+        vals = series.to_numpy(dtype=float); wts = df.loc[series.index, "weight"].to_numpy(dtype=float)
+        ok = ~(np.isnan(vals) | np.isnan(wts))
+        return float(np.average(vals[ok], weights=wts[ok])) if ok.any() else np.nan
+
+    ev_stand = wmean(df["ev_stand"]) if "ev_stand" in df.columns else wmean(df["stand"])
+    ev_hit_one = wmean(df["hit"])
+    ev_hit_roll = wmean(df["ev_hit_rollout"]) if "ev_hit_rollout" in df.columns else None
 
-    def wdl(series: pd.Series): return (series==1).mean(), (series==0).mean(), (series==-1).mean()
+    def wdl(series: pd.Series): return wmean(series==1), wmean(series==0), wmean(series==-1)
     w_s,d_s,l_s = wdl(df["stand"]); w_h,d_h,l_h = wdl(df["hit"])
 
     by_up = df.groupby("score_dealer", as_index=False).agg(
-        ev_stand=("ev_stand","mean") if "ev_stand" in df.columns else ("stand","mean"),
-        ev_hit=("ev_hit_rollout","mean") if "ev_hit_rollout" in df.columns else ("hit","mean"),
+        ev_stand=("ev_stand",wmean) if "ev_stand" in df.columns else ("stand",wmean),
+        ev_hit=("ev_hit_rollout",wmean) if "ev_hit_rollout" in df.columns else ("hit",wmean),
         n=("stand","size")
     ).sort_values("score_dealer")
 
@@ -373,23 +510,91 @@ class Rules:
     allow_double_any: bool = True    # double on any two
     double_9_to_11_only: bool = False  # restrict doubles to hard 9–11 when True
     surrender: bool = False          
+    penetration: float | None = None # fraction dealt before the cut card (None = 1 deck left)
+    csm: bool = False                # continuous shuffling machine
 
 class Shoe:
-    def __init__(self, n_decks: int, rng: random.Random):
-        self.n_decks = n_decks; self.rng = rng; self._new_shoe()
+    """
+    Finite shoe with lazy (on-demand) Fisher-Yates shuffling.
+    `cards[:left]` is the undealt part. A reshuffle runs Fisher-Yates only over
+    the positions dealt before the cut card (one tight loop), so the rest of the
+    shoe is never shuffled and draw() is an index decrement. Past `_lazy` (after
+    a refill, or always with csm) each draw swaps a uniformly chosen undealt card
+    to the end of the undealt region first; both paths give the same cards.
+    - penetration: fraction of the shoe dealt before the cut card
+      (None = reshuffle when fewer than one deck remains).
+    - csm: continuous shuffling machine, discards go back after every round.
+    With a CounterRNG, shoe number k always starts from the same card order
+    and draws from stream (seed, k), so it does not depend on earlier shoes;
+    `first_shoe` sets the index of the first shoe.
+    If a round runs the shoe dry, only the discards of earlier rounds are
+    reshuffled (see _refill); cards of the current round stay out of play.
+    `shuffles` is the current shoe index; `epoch` counts every refill.
+    """
+    def __init__(self, n_decks: int, rng: random.Random,
+                 penetration: float | None = None, csm: bool = False, first_shoe: int = 0):
+        self.n_decks = n_decks; self.rng = rng; self.csm = csm
+        self.shuffles = first_shoe - 1; self.epoch = -1
+        self.history = None   # HandHistory to sync before cards are rearranged
+        self.keyed = isinstance(rng, CounterRNG); self._spent = False
+        self._below = rng._randbelow   # == rng.randrange(n) for n > 0, one call cheaper
+        self._base = []
+        for _ in range(n_decks): self._base.extend(self._one_deck())
+        self.cards = list(self._base)
+        n = len(self.cards)
+        if penetration is None:
+            self.cut = n - 51
+        elif 0 < penetration <= 1:
+            self.cut = max(1, int(round(penetration * n)))
+        else:
+            raise ValueError(f"penetration must be in (0, 1], got {penetration}")
+        self._floor = n - 1 if csm else n - self.cut   # reshuffle once left <= _floor
+        self._new_shoe()
     def _one_deck(self):
         ranks=[]
         for r in [2,3,4,5,6,7,8,9]: ranks += [r]*4
         ranks += [10]*16; ranks += ['A']*4
         return ranks
     def _new_shoe(self):
-        self.cards=[]
-        for _ in range(self.n_decks): self.cards.extend(self._one_deck())
-        self.rng.shuffle(self.cards)
+        if self.history is not None: self.history.sync(self)
+        self.left = self.round_top = len(self.cards); self.shuffles += 1; self.epoch += 1
+        self._spent = False
+        if self.keyed:
+            self.cards[:] = self._base; self.rng.jump(self.shuffles)
+        cards, below = self.cards, self._below
+        self._lazy = lazy = self._floor + 1 if self.csm else self._floor
+        for i in range(len(cards) - 1, max(lazy, 1) - 1, -1):
+            j = below(i + 1)
+            cards[i], cards[j] = cards[j], cards[i]
+    def begin_round(self):
+        """Mark the start of a round: its cards will be dealt from below `round_top`."""
+        self.round_top = self.left
+    def _refill(self):
+        """
+        Shoe ran out mid-round: the current round's cards are cards[:round_top],
+        the discards of earlier rounds are cards[round_top:]. Move the round's
+        cards to the top and make the discards the new undealt region, so the
+        round's cards stay contiguous (and in dealing order) below the top.
+        Keyed shoes draw the rest from a side stream of the same shoe index.
+        The shoe is reshuffled before the next round.
+        """
+        if self.history is not None: self.history.sync(self)
+        n, r = len(self.cards), self.round_top
+        if r == n: raise RuntimeError("shoe exhausted by a single round")
+        self.cards[:] = self.cards[r:] + self.cards[:r]
+        self.left = self._lazy = n - r; self.round_top = n; self.epoch += 1; self._spent = True
+        if self.keyed: self.rng.jump(self.shuffles, stream=1)
     def draw(self):
-        if not self.cards: self._new_shoe()
-        return self.cards.pop()
-    def need_shuffle(self): return len(self.cards) < 52
+        i = self.left - 1
+        if i < self._lazy:   # not pre-shuffled (or empty): shuffle this position now
+            if i < 0: self._refill(); i = self.left - 1
+            if i:
+                j = self._below(i + 1)
+                self.cards[i], self.cards[j] = self.cards[j], self.cards[i]
+        self.left = i
+        return self.cards[i]
+    def dealt(self): return len(self.cards) - self.left
+    def need_shuffle(self): return self.left <= self._floor or self._spent
 
 class Hand:
     def __init__(self, cards=None): self.cards = cards or []
@@ -483,47 +688,260 @@ class BasicStrategy:
             return 'D' if (can_double and up in [3,4,5,6]) else 'H'
         return 'H'  # 8 or less
 
+# PER-STATE statistics (finite-shoe decision-state EVs)
+STATE_KINDS = ("hard", "soft", "pair")
+STATE_ACTIONS = ("H", "S", "D", "P")
+
+class StateStats:
+    """
+    Per-decision-state accumulators for the full-game simulator.
+    Cells are indexed by (kind, player total, dealer upcard, action taken) where
+    kind is hard/soft/pair. Each cell keeps the count, EV sum and EV sum of squares
+    of the net units won by all hands that descended from that decision.
+    """
+    def __init__(self):
+        shape = (len(STATE_KINDS), 22, 10, len(STATE_ACTIONS))
+        self.counts = np.zeros(shape, dtype=np.int64)
+        self.ev_sum = np.zeros(shape, dtype=np.float64)
+        self.ev_sq = np.zeros(shape, dtype=np.float64)
+        self._cells = []   # decision cells visited in the current round
+        self._paths = []   # decision ids leading to each resolved hand
+
+    def decision(self, hand: Hand, dealer_up, action: str) -> int:
+        """Record a decision of the current round; returns its id for the hand path."""
+        t, soft = hand.total_and_soft()
+        cards = hand.cards
+        if len(cards) == 2 and cards[0] == cards[1]: kind = 2
+        else: kind = 1 if soft else 0
+        up = 11 if dealer_up == 'A' else int(dealer_up)
+        self._cells.append((kind, t, up - 2, STATE_ACTIONS.index(action)))
+        return len(self._cells) - 1
+
+    def resolve(self, path: Tuple[int, ...]):
+        """Attach the decision path of a resolved hand (same order as the resolved list)."""
+        self._paths.append(path)
+
+    def settle(self, nets: List[float]):
+        """
+        Credit each resolved hand's net to every decision on its path,
+        so a split decision collects the sum of both resulting hands.
+        """
+        vals = [0.0] * len(self._cells)
+        for path, net in zip(self._paths, nets):
+            for i in path: vals[i] += net
+        for cell, v in zip(self._cells, vals):
+            self.counts[cell] += 1; self.ev_sum[cell] += v; self.ev_sq[cell] += v * v
+        self._cells.clear(); self._paths.clear()
+
+    def merge(self, other: "StateStats") -> "StateStats":
+        self.counts += other.counts; self.ev_sum += other.ev_sum; self.ev_sq += other.ev_sq
+        return self
+
+    def to_frame(self) -> pd.DataFrame:
+        """Compact table of the visited cells with mean EV and its standard error."""
+        kind, total, up, act = np.nonzero(self.counts)
+        n = self.counts[kind, total, up, act]
+        mean = self.ev_sum[kind, total, up, act] / n
+        var = np.maximum(self.ev_sq[kind, total, up, act] / n - mean**2, 0.0)
+        return pd.DataFrame({
+            "kind": np.array(STATE_KINDS)[kind],
+            "total": total,
+            "upcard": up + 2,
+            "action": np.array(STATE_ACTIONS)[act],
+            "n": n,
+            "ev_mean": mean,
+            "ev_se": np.sqrt(var / n),
+        })
+
+# HAND HISTORY (fixed-width binary round log)
+HISTORY_MAX_CARDS = 24
+HISTORY_MAX_ACTIONS = 20
+HIST_RESHUFFLED = 1   # shoe ran out mid-round and the earlier discards were reshuffled
+HIST_TRUNCATED = 2    # more cards/actions than fit in the record
+HISTORY_MAGIC = b"BJHIST\x00\x02"
+
+# 72 bytes per round (little-endian, packed)
+HISTORY_DTYPE = np.dtype([
+    ("seed", "<i8"), ("round", "<u4"), ("shoe", "<u4"),   # shoe = Shoe.shuffles (CounterRNG stream index)
+    ("flags", "u1"), ("n_cards", "u1"), ("n_actions", "u1"), ("n_hands", "u1"),
+    ("wagered", "<f4"), ("net", "<f4"),
+    ("cards", "u1", (HISTORY_MAX_CARDS,)),       # 2..10, 11 = Ace, in dealing order
+    ("actions", "u1", (HISTORY_MAX_ACTIONS,)),   # 1 + index in STATE_ACTIONS
+])
+# Fixed fields + actions are packed per round; cards are filled in per shoe (HandHistory.sync)
+_HIST_HEAD = struct.Struct(f"<qIIBBBBff{HISTORY_MAX_CARDS}x{HISTORY_MAX_ACTIONS}s")
+_ACTION_CODE = {a: i + 1 for i, a in enumerate(STATE_ACTIONS)}
+_CARD_CODE = {r: 11 if r == 'A' else r for r in RANKS}
+
+class HandHistory:
+    """
+    Append-only writer of one HISTORY_DTYPE record per round.
+    The file starts with a small header (magic, JSON length, JSON with the
+    seed, rules and policy) so a log can be replayed with its own settings.
+    Records are written into a preallocated buffer and flushed in bulk.
+    Per round only the fixed fields and actions are packed; the round's
+    cards stay in the shoe at `cards[top-n_cards:top]` (reverse dealing
+    order) until the shoe is reshuffled, and sync() then encodes them for
+    all pending rounds at once. Use as a context manager so the tail is flushed.
+    """
+    def __init__(self, path: str, seed: int, meta: Dict | None = None, buffer_rounds: int = 8192):
+        self.seed = seed; self.round = 0
+        self.buf = bytearray(HISTORY_DTYPE.itemsize * buffer_rounds)
+        self.recs = np.frombuffer(self.buf, dtype=HISTORY_DTYPE)
+        self.cap = buffer_rounds; self.n = 0
+        self.actions = bytearray()
+        self._shoe = None; self._pending = []
+        self.f = open(path, "wb")
+        head = json.dumps({"format": 2, "seed": seed, **(meta or {})}).encode()
+        self.f.write(HISTORY_MAGIC + struct.pack("<I", len(head)) + head)
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+    def begin(self, shoe: Shoe):
+        shoe.history = self; self._shoe = shoe
+        self._epoch = shoe.epoch
+        self.actions.clear()
+
+    def action(self, a: str): self.actions.append(_ACTION_CODE[a])
+
+    def end(self, shoe: Shoe, wagered: float, n_hands: int, net: float):
+        top = shoe.round_top; acts = self.actions
+        nc = top - shoe.left; na = len(acts)
+        flags = HIST_RESHUFFLED if shoe.epoch != self._epoch else 0
+        if nc > HISTORY_MAX_CARDS or na > HISTORY_MAX_ACTIONS:
+            flags |= HIST_TRUNCATED
+            nc = min(nc, HISTORY_MAX_CARDS); na = min(na, HISTORY_MAX_ACTIONS); acts = acts[:na]
+        _HIST_HEAD.pack_into(self.buf, self.n * HISTORY_DTYPE.itemsize, self.seed, self.round,
+                             shoe.shuffles, flags, nc, na, n_hands, wagered, net, acts)
+        self._pending.append((self.n, top, nc))
+        self.round += 1; self.n += 1
+        if self.n == self.cap: self.flush()
+
+    def sync(self, shoe: Shoe):
+        """Encode the cards of pending rounds; Shoe calls this before rearranging its cards."""
+        pending = self._pending
+        if not pending: return
+        hi = pending[0][1]; lo = pending[-1][1] - pending[-1][2]
+        codes = bytes(map(_CARD_CODE.__getitem__, reversed(shoe.cards[lo:hi])))   # dealing order
+        buf = self.buf; size = HISTORY_DTYPE.itemsize; off = HISTORY_DTYPE.fields["cards"][1]
+        for slot, top, nc in pending:
+            o = slot * size + off; i = hi - top
+            buf[o:o + nc] = codes[i:i + nc]
+        pending.clear()
+
+    def flush(self):
+        if self._shoe is not None: self.sync(self._shoe)
+        self.f.write(memoryview(self.buf)[:self.n * HISTORY_DTYPE.itemsize])
+        self.n = 0
+
+    def close(self):
+        if self.f.closed: return
+        try: self.flush()
+        finally: self.f.close()
+
+def load_history(path: str) -> Tuple[Dict, np.ndarray]:
+    """Read a hand-history header and memory-map its records (read-only HISTORY_DTYPE array)."""
+    with open(path, "rb") as f:
+        if f.read(len(HISTORY_MAGIC)) != HISTORY_MAGIC: raise ValueError(f"{path} is not a hand-history log")
+        (n,) = struct.unpack("<I", f.read(4))
+        meta = json.loads(f.read(n))
+    offset = len(HISTORY_MAGIC) + 4 + n
+    if os.path.getsize(path) == offset: return meta, np.zeros(0, dtype=HISTORY_DTYPE)
+    return meta, np.memmap(path, dtype=HISTORY_DTYPE, mode="r", offset=offset)
+
+def describe_record(rec) -> str:
+    """One-line human-readable view of a history record."""
+    cards = ['A' if c == 11 else str(c) for c in rec["cards"][:rec["n_cards"]]]
+    acts = "".join(STATE_ACTIONS[a - 1] for a in rec["actions"][:rec["n_actions"]])
+    flags = [n for n, bit in (("reshuffled", HIST_RESHUFFLED), ("truncated", HIST_TRUNCATED)) if rec["flags"] & bit]
+    return (f"seed={rec['seed']} round={rec['round']} shoe={rec['shoe']} cards={' '.join(cards)} actions={acts or '-'} "
+            f"hands={rec['n_hands']} wagered={rec['wagered']:g} net={rec['net']:+g}"
+            + (f" [{','.join(flags)}]" if flags else ""))
+
+class ReplayExhausted(Exception):
+    """The replayed round asked for more cards than were recorded."""
+
+class ReplayShoe:
+    """Shoe stand-in that deals a recorded card sequence (for replaying a round)."""
+    def __init__(self, cards): self.cards = ['A' if c == 11 else int(c) for c in cards]; self.i = 0
+    def need_shuffle(self): return False
+    def begin_round(self): pass
+    def draw(self):
+        if self.i >= len(self.cards): raise ReplayExhausted()
+        c = self.cards[self.i]; self.i += 1
+        return c
+
+def replay_record(rec, rules: Rules, policy: str) -> float | None:
+    """
+    Re-play a recorded round with the given rules/policy from its dealt cards.
+    Returns the net, or None if the round does not use exactly the recorded
+    cards (the log came from other settings). Truncated records cannot be replayed.
+    """
+    if rec["flags"] & HIST_TRUNCATED: raise ValueError(f"round {rec['round']} is truncated")
+    shoe = ReplayShoe(rec["cards"][:rec["n_cards"]])
+    try:
+        net = play_round(shoe, rules, policy)
+    except ReplayExhausted:
+        return None
+    return net if shoe.i == len(shoe.cards) else None
+
 # NAIVE policy (for comparison / dataset rollouts)
-def naive_player(hand: Hand, upcard, shoe: Shoe):
+def naive_player(hand: Hand, upcard, shoe: Shoe, sstats: StateStats | None = None,
+                 history: HandHistory | None = None):
     """
     Keep hitting while:
       - soft hand and total <= 17, or
       - hard hand and total <= 16.
     Otherwise stand.
     """
+    path = ()
     while True:
         t, soft = hand.total_and_soft()
-        if t > 21: return hand
+        if t > 21: break
         if (soft and t <= 17) or (not soft and t <= 16):
+            if sstats is not None: path += (sstats.decision(hand, upcard, 'H'),)
+            if history is not None: history.action('H')
             hand.add(shoe.draw()); continue
-        return hand
+        if sstats is not None: path += (sstats.decision(hand, upcard, 'S'),)
+        if history is not None: history.action('S')
+        break
+    if sstats is not None: sstats.resolve(path)
+    return hand
 
 # BASIC strategy executor: handles splits/doubles 
-def play_player_basic(initial: Hand, dealer_up, shoe: Shoe, rules: Rules) -> List[Tuple[int, int, bool]]:
+def play_player_basic(initial: Hand, dealer_up, shoe: Shoe, rules: Rules,
+                      sstats: StateStats | None = None,
+                      history: HandHistory | None = None) -> List[Tuple[int, int, bool]]:
     """
     Play out the player's turn using Basic Strategy.
     Returns a list of resolved hands as tuples:
       (final_total, bet_units, is_bust)
+    If `sstats` is given, each decision is recorded and every resolved hand
+    registers the path of decisions that led to it. If `history` is given,
+    the actions taken are appended to the current round record.
     """
    
     strat = BasicStrategy(rules)
     resolved = []
-    # stack: (hand, bet_units, splits_done, after_split, split_aces_flag)
-    stack = [(initial, 1, 0, False, False)]
+    # stack: (hand, bet_units, splits_done, after_split, split_aces_flag, decision_path)
+    stack = [(initial, 1, 0, False, False, ())]
 
     while stack:
-        hand, bet, splits_done, after_split, split_aces = stack.pop()
+        hand, bet, splits_done, after_split, split_aces, path = stack.pop()
 
         # If split aces and no hits allowed -> stand immediately
         if split_aces and not rules.hit_split_aces:
             t,_ = hand.total_and_soft()
             resolved.append((t, bet, t>21))
+            if sstats is not None: sstats.resolve(path)
             continue
 
         while True:
             t, soft = hand.total_and_soft()
             if t > 21:
                 resolved.append((t, bet, True))
+                if sstats is not None: sstats.resolve(path)
                 break
 
             # Double Logi
@@ -540,9 +958,15 @@ def play_player_basic(initial: Hand, dealer_up, shoe: Shoe, rules: Rules) -> Lis
             can_split = (len(hand.cards) == 2) and (splits_done < rules.max_splits) and (hand.cards[0] == hand.cards[1])
 
             action = strat.decide(hand, dealer_up, can_double, can_split, after_split)
+            if sstats is not None or history is not None:
+                taken = 'H' if (action == 'P' and not can_split) else action
+                if sstats is not None: path += (sstats.decision(hand, dealer_up, taken),)
+                if history is not None: history.action(taken)
 
             if action == 'S':
-                resolved.append((t, bet, False)); break
+                resolved.append((t, bet, False))
+                if sstats is not None: sstats.resolve(path)
+                break
 
             if action == 'H':
                 hand.add(shoe.draw()); continue
@@ -551,7 +975,9 @@ def play_player_basic(initial: Hand, dealer_up, shoe: Shoe, rules: Rules) -> Lis
                 bet *= 2
                 hand.add(shoe.draw())
                 t,_ = hand.total_and_soft()
-                resolved.append((t, bet, t>21)); break
+                resolved.append((t, bet, t>21))
+                if sstats is not None: sstats.resolve(path)
+                break
 
             if action == 'P' and can_split:
                 rank = hand.cards[0]
@@ -559,7 +985,7 @@ def play_player_basic(initial: Hand, dealer_up, shoe: Shoe, rules: Rules) -> Lis
                 h1.add(shoe.draw()); h2.add(shoe.draw())
                 ace_split = (rank == 'A')
                 # push the second; continue with the first 
-                stack.append((h2, bet, splits_done+1, True, ace_split))
+                stack.append((h2, bet, splits_done+1, True, ace_split, path))
                 hand, bet, splits_done, after_split, split_aces = h1, bet, splits_done+1, True, ace_split
                 
                 continue
@@ -596,67 +1022,162 @@ def settle_hand(player_total: int, bet: int, dealer_total: int) -> float:
     if player_total < dealer_total: return -bet
     return 0.0
 
-def simulate_hands_for_deck(n_games: int, n_decks: int, rules: Rules, seed: int, policy: str):
+def play_round(shoe: Shoe, rules: Rules, policy: str, sstats: StateStats | None = None,
+               history: HandHistory | None = None) -> float:
+    """
+    Deal and resolve one round from the shoe (reshuffling first if needed).
+    Returns the player's net units for the round, including splits/doubles.
+    """
+    if shoe.need_shuffle(): shoe._new_shoe()
+    shoe.begin_round()
+    if history is not None: history.begin(shoe)
+    draw = shoe.draw
+    p = Hand([draw(), draw()])
+    d = Hand([draw(), draw()])
+
+    # Naturals (blackjacks)
+    p_bj, d_bj = p.is_blackjack(), d.is_blackjack()
+    if p_bj or d_bj:
+        if p_bj and d_bj: r = 0.0
+        elif p_bj: r = rules.blackjack_payout
+        else: r = -1.0
+        if history is not None: history.end(shoe, 1, 1, r)
+        return r
+
+    up = d.cards[0]
+
+    # Player phase
+    if policy == "basic":
+        hands = play_player_basic(p, up, shoe, rules, sstats, history)
+    else:  # naive
+        p = naive_player(p, up, shoe, sstats, history)
+        hands = [(p.total(), 1, p.total() > 21)]
+
+    # If every hand busted, no need to finish dealer
+    if not any(t <= 21 for (t, _, _) in hands):
+        nets = [-bet for (_, bet, _) in hands]
+    else:
+        d = play_dealer(d, shoe, rules)
+        dt = d.total()
+        # Settle each hand vs dealer
+        nets = [settle_hand(t, bet, dt) for t, bet, _ in hands]
+    if sstats is not None: sstats.settle(nets)
+    net = sum(nets)
+    if history is not None: history.end(shoe, sum(bet for (_, bet, _) in hands), len(hands), net)
+    return net
+
+def simulate_hands_for_deck(n_games: int, n_decks: int, rules: Rules, seed: int, policy: str,
+                            state_stats: bool = False, history_path: str | None = None):
     """
     Run Monte Carlo rounds for a given shoe size and policy.
     Tracks total EV and counts of win/draw/loss at the round level.
+    With `state_stats`, also accumulates per-decision-state EVs (see StateStats).
+    With `history_path`, every round is logged there as a binary record (see HandHistory).
     """
     rng = random.Random(seed)
-    shoe = Shoe(n_decks, rng)
+    shoe = Shoe(n_decks, rng, penetration=rules.penetration, csm=rules.csm)
+    sstats = StateStats() if state_stats else None
     total_ev = 0.0
     wins = draws = losses = 0
 
-    for _ in range(n_games):
-        if shoe.need_shuffle(): shoe._new_shoe()
-        p = Hand([shoe.draw(), shoe.draw()])
-        d = Hand([shoe.draw(), shoe.draw()])
-
-        # Naturals (blackjacks)
-        if p.is_blackjack() or d.is_blackjack():
-            if p.is_blackjack() and d.is_blackjack(): r = 0.0
-            elif p.is_blackjack(): r = rules.blackjack_payout
-            else: r = -1.0
-            total_ev += r
-            if r > 0: wins += 1
-            elif r == 0: draws += 1
-            else: losses += 1
-            continue
-
-        up = d.cards[0]
-
-        # Player phase
-        if policy == "basic":
-            hands = play_player_basic(p, up, shoe, rules)
-        else:  # naive
-            p = naive_player(p, up, shoe)
-            hands = [(p.total(), 1, p.total() > 21)]
-
-        # If every hand busted, no need to finish dealer
-        if not any(t <= 21 for (t, _, _) in hands):
-            net = sum(-bet for (_, bet, _) in hands)
+    meta = {"policy": policy, "decks": n_decks, "rules": asdict(rules)}
+    with (HandHistory(history_path, seed, meta) if history_path else contextlib.nullcontext()) as history:
+        for _ in range(n_games):
+            net = play_round(shoe, rules, policy, sstats, history)
             total_ev += net
             if net > 0: wins += 1
             elif net == 0: draws += 1
             else: losses += 1
-            continue
 
-        d = play_dealer(d, shoe, rules)
-        dt = d.total()
-
-        # Settle each hand vs dealer
-        net = 0.0
-        for t, bet, _ in hands:
-            net += settle_hand(t, bet, dt)
+    res = {"decks": n_decks,
+           "ev_per_hand": total_ev / n_games,
+           "wins": wins, "draws": draws, "losses": losses,
+           "hands": n_games}
+    if sstats is not None: res["state_stats"] = sstats
+    return res
 
-        total_ev += net
-        if net > 0: wins += 1
-        elif net == 0: draws += 1
-        else: losses += 1
+def simulate_shoes(n_decks: int, rules: Rules, seed: int, policy: str, first_shoe: int, n_shoes: int,
+                   state_stats: bool = False, history_path: str | None = None):
+    """
+    Counter-RNG counterpart of simulate_hands_for_deck: play shoes
+    first_shoe .. first_shoe+n_shoes-1 to their cut card. Each shoe depends
+    only on (seed, shoe index), so any split of the shoe range gives the same
+    per-shoe results. Returns per-shoe net totals in `shoe_nets`.
+    """
+    shoe = Shoe(n_decks, CounterRNG(seed), penetration=rules.penetration, csm=rules.csm,
+                first_shoe=first_shoe)
+    sstats = StateStats() if state_stats else None
+    shoe_nets = []
+    hands = wins = draws = losses = 0
+
+    meta = {"policy": policy, "decks": n_decks, "rules": asdict(rules), "rng": "counter"}
+    with (HandHistory(history_path, seed, meta) if history_path else contextlib.nullcontext()) as history:
+        for _ in range(n_shoes):
+            shoe_net = 0.0
+            while True:
+                net = play_round(shoe, rules, policy, sstats, history)
+                shoe_net += net; hands += 1
+                if net > 0: wins += 1
+                elif net == 0: draws += 1
+                else: losses += 1
+                if shoe.need_shuffle(): break
+            shoe_nets.append(shoe_net)
+
+    res = {"decks": n_decks, "shoe_nets": shoe_nets,
+           "wins": wins, "draws": draws, "losses": losses, "hands": hands}
+    if sstats is not None: res["state_stats"] = sstats
+    return res
+
+def merge_shoe_results(parts: List[Dict]) -> Dict:
+    """
+    Combine simulate_shoes chunks of one replicate (in shoe order) into a
+    simulate_hands_for_deck-style result. fsum makes the EV independent of
+    how the shoes were chunked.
+    """
+    hands = sum(x["hands"] for x in parts)
+    res = {"decks": parts[0]["decks"],
+           "ev_per_hand": math.fsum(v for x in parts for v in x["shoe_nets"]) / hands,
+           "wins": sum(x["wins"] for x in parts), "draws": sum(x["draws"] for x in parts),
+           "losses": sum(x["losses"] for x in parts), "hands": hands}
+    if "state_stats" in parts[0]:
+        merged = StateStats()
+        for x in parts: merged.merge(x["state_stats"])
+        res["state_stats"] = merged
+    return res
+
+def shoes_for_rounds(n_games: int, n_decks: int, rules: Rules) -> int:
+    """
+    Whole shoes needed for about n_games rounds. A round starts whenever
+    fewer than `cut` cards are dealt, at about 5.4 cards per round.
+    """
+    if rules.csm: return n_games
+    cut = Shoe(n_decks, random.Random(0), penetration=rules.penetration).cut
+    return max(1, math.ceil(n_games / max(1.0, cut / 5.4 + 0.5)))
 
-    return {"decks": n_decks,
-            "ev_per_hand": total_ev / n_games,
-            "wins": wins, "draws": draws, "losses": losses,
-            "hands": n_games}
+def round_outcomes(n_rounds: int, n_decks: int, rules: Rules, seed: int, policy: str) -> np.ndarray:
+    """Per-round net units for `n_rounds` consecutive rounds from one shoe."""
+    rng = random.Random(seed)
+    shoe = Shoe(n_decks, rng, penetration=rules.penetration, csm=rules.csm)
+    out = np.empty(n_rounds, dtype=np.float64)
+    for i in range(n_rounds):
+        out[i] = play_round(shoe, rules, policy)
+    return out
+
+def rules_from_args(args) -> Rules:
+    """Build the rule set from the shared house-rule CLI flags."""
+    return Rules(hit_soft_17=not args.s17,
+                 blackjack_payout=args.bj_payout,
+                 das=not args.no_das,
+                 max_splits=args.max_splits,
+                 hit_split_aces=args.hit_split_aces,
+                 allow_double_any=not args.double_9_to_11_only,
+                 double_9_to_11_only=args.double_9_to_11_only,
+                 surrender=False,
+                 penetration=args.penetration,
+                 csm=args.csm)
+
+def n_workers(args) -> int:
+    return max(1, cpu_count()-1) if args.workers == 'auto' else int(args.workers)
 
 def simulate_cli(args):
     """
@@ -664,27 +1185,40 @@ def simulate_cli(args):
       - jobs across deck counts and replicates
       - Aggregates results, writes CSV, and plots EV with 95% CI
     """
-    rules = Rules(hit_soft_17=not args.s17,
-                  blackjack_payout=args.bj_payout,
-                  das=not args.no_das,
-                  max_splits=args.max_splits,
-                  hit_split_aces=args.hit_split_aces,
-                  allow_double_any=not args.double_9_to_11_only,
-                  double_9_to_11_only=args.double_9_to_11_only,
-                  surrender=False)
+    rules = rules_from_args(args)
     base_seed = args.seed if args.seed is not None else 12345
-    jobs = []
+    counter = (args.rng == "counter")
+    jobs, owners = [], []
     k = 0
+    hist_dir = os.path.join(args.outdir, "history") if args.history else None
+    if hist_dir: os.makedirs(hist_dir, exist_ok=True)
     for rep in range(args.replicates):
         for d in args.decks:
-            jobs.append((args.n_games, d, rules, base_seed + 7919*k, args.policy))
+            seed = base_seed + 7919*k
+            if counter:
+                # Split the replicate into shoe ranges; results do not depend on the split
+                n_shoes = args.n_shoes or shoes_for_rounds(args.n_games, d, rules)
+                for first in range(0, n_shoes, args.shoes_per_job):
+                    m = min(args.shoes_per_job, n_shoes - first)
+                    hist = (os.path.join(hist_dir, f"decks{d}_rep{rep}_seed{seed}_shoes{first}-{first+m-1}.bjh")
+                            if hist_dir else None)
+                    jobs.append((d, rules, seed, args.policy, first, m, args.state_stats, hist))
+                    owners.append(k)
+            else:
+                hist = os.path.join(hist_dir, f"decks{d}_rep{rep}_seed{seed}.bjh") if hist_dir else None
+                jobs.append((args.n_games, d, rules, seed, args.policy, args.state_stats, hist))
             k += 1
-    workers = max(1, cpu_count()-1) if args.workers == 'auto' else int(args.workers)
+    func = simulate_shoes if counter else simulate_hands_for_deck
+    workers = n_workers(args)
     if workers > 1:
         with Pool(processes=workers) as pool:
-            results = pool.starmap(simulate_hands_for_deck, jobs)
+            results = pool.starmap(func, jobs)
     else:
-        results = [simulate_hands_for_deck(*job) for job in jobs]
+        results = [func(*job) for job in jobs]
+    if counter:
+        chunks = {}
+        for owner, r in zip(owners, results): chunks.setdefault(owner, []).append(r)
+        results = [merge_shoe_results(chunks[o]) for o in sorted(chunks)]
 
     os.makedirs(args.outdir, exist_ok=True)
     by_deck = {}
@@ -705,6 +1239,16 @@ def simulate_cli(args):
                         100*stats.mean(winp), 100*stats.mean(drawp), 100*stats.mean(losep)])
     print(f"Saved round-level summary to {out_csv}")
 
+    if args.state_stats:
+        frames = []
+        for d in sorted(by_deck):
+            merged = StateStats()
+            for x in by_deck[d]: merged.merge(x["state_stats"])
+            tab = merged.to_frame(); tab.insert(0, "decks", d); frames.append(tab)
+        state_csv = os.path.join(args.outdir, "state_ev_table.csv")
+        pd.concat(frames, ignore_index=True).to_csv(state_csv, index=False, float_format="%.6f")
+        print(f"Saved per-state EV table to {state_csv}")
+
     xs, means, lows, highs = [], [], [], []
     for d in sorted(by_deck):
         vals = [x["ev_per_hand"] for x in by_deck[d]]
@@ -726,8 +1270,234 @@ def simulate_cli(args):
         losep = 100*stats.mean([x["losses"]/x["hands"] for x in reps])
         print(f"Decks={d}: Win {winp:.2f}%  Draw {drawp:.2f}%  Lose {losep:.2f}%  |  EV {stats.mean([x['ev_per_hand'] for x in reps]):+.4f}")
 
+# BANKROLL / SESSION simulation
+
+class QuantileSketch:
+    """
+    Streaming quantile estimator (merging t-digest).
+    Values are folded in batches into at most ~delta/2 weighted centroids,
+    kept small near the tails, so memory stays constant however many
+    values are added.
+    """
+    def __init__(self, delta: int = 500):
+        self.delta = delta
+        self.means = np.empty(0); self.weights = np.empty(0)
+        self.n = 0; self.min = math.inf; self.max = -math.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.size == 0: return
+        self.n += values.size
+        self.min = min(self.min, float(values.min())); self.max = max(self.max, float(values.max()))
+        m = np.concatenate([self.means, values])
+        w = np.concatenate([self.weights, np.ones(values.size)])
+        order = np.argsort(m, kind="stable"); m = m[order]; w = w[order]
+        q_left = (np.cumsum(w) - w) / w.sum()
+        # k1 scale function: one unit of k per centroid
+        k = self.delta / (2*math.pi) * np.arcsin(2*q_left - 1)
+        group = np.floor(k - k[0]).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+        self.weights = np.add.reduceat(w, starts)
+        self.means = np.add.reduceat(m * w, starts) / self.weights
+
+    def quantile(self, q):
+        """Interpolated quantile(s) for q in [0, 1]."""
+        if self.n == 0: return np.full(np.shape(q), np.nan)
+        mids = np.cumsum(self.weights) - self.weights / 2
+        xs = np.r_[0.0, mids, float(self.n)]
+        ys = np.r_[self.min, self.means, self.max]
+        return np.interp(np.asarray(q, dtype=np.float64) * self.n, xs, ys)
+
+def simulate_sessions(outcomes: np.ndarray, n_sessions: int, n_rounds: int, bankroll: float,
+                      bet: float, seed: int, batch: int = 100_000, n_checkpoints: int = 20) -> Dict:
+    """
+    Simulate bankroll sessions in parallel as NumPy arrays.
+    Each round's net is resampled from `outcomes` (per-round nets produced by
+    the full-game engine) and scaled by the flat `bet`. A round is only
+    played while the bankroll covers its worst possible loss
+    (bet * max(1, -min(outcomes)), i.e. all splits and doubles lost); below
+    that the session is ruined and stops, so a bankroll never goes negative.
+    Sessions run in batches and are summarised with running sums and
+    QuantileSketch objects, so memory does not grow with n_sessions.
+    """
+    rng = np.random.default_rng(seed)
+    checkpoints = np.unique(np.linspace(0, n_rounds, n_checkpoints + 1).astype(int)[1:])
+    checkpoints = checkpoints[checkpoints > 0]   # short sessions: flooring can yield round 0
+    bands = [QuantileSketch() for _ in checkpoints]
+    result_q, ruin_q = QuantileSketch(), QuantileSketch()
+    stake = bet * max(1.0, -float(outcomes.min()))   # worst-case loss of one round
+    n_ruined = 0; ruin_time_sum = 0.0; res_sum = 0.0; res_sq = 0.0
+
+    done = 0
+    while done < n_sessions:
+        b = min(batch, n_sessions - done)
+        bank = np.full(b, float(bankroll))
+        alive = bank >= stake
+        t_ruin = np.where(alive, -1, 0)   # -1 = never ruined
+        ci = 0
+        for t in range(1, n_rounds + 1):
+            idx = np.flatnonzero(alive)
+            if idx.size:
+                bank[idx] += bet * outcomes[rng.integers(0, outcomes.size, size=idx.size)]
+                broke = idx[bank[idx] < stake]
+                t_ruin[broke] = t; alive[broke] = False
+            if t == checkpoints[ci]:
+                bands[ci].update(bank); ci += 1
+
+        res = bank - bankroll
+        result_q.update(res)
+        res_sum += float(res.sum()); res_sq += float((res * res).sum())
+        ruined = t_ruin[t_ruin >= 0]
+        n_ruined += ruined.size; ruin_time_sum += float(ruined.sum())
+        ruin_q.update(ruined)
+        done += b
+
+    if any(band.n != n_sessions for band in bands):
+        raise RuntimeError("a checkpoint band did not see every session")
+    mean = res_sum / n_sessions
+    return {"sessions": n_sessions,
+            "ruin_prob": n_ruined / n_sessions,
+            "mean_rounds_to_ruin": ruin_time_sum / n_ruined if n_ruined else np.nan,
+            "ruin_times": ruin_q,
+            "mean_result": mean,
+            "sd_result": math.sqrt(max(res_sq / n_sessions - mean**2, 0.0)),
+            "results": result_q,
+            "checkpoints": checkpoints,
+            "bands": bands}
+
+def bankroll_cli(args):
+    """
+      - Builds a pool of per-round outcomes from the full-game engine
+      - Runs many bankroll sessions against it in vectorised batches
+      - Writes ruin / session-result summary, quantile bands CSV and plot
+    """
+    rules = rules_from_args(args)
+    # Fixed-size chunks so the pool does not depend on the worker count
+    chunk = 50_000
+    jobs, k, left = [], 0, args.pool_rounds
+    while left > 0:
+        jobs.append((min(chunk, left), args.decks, rules, args.seed + 7919*k, args.policy))
+        left -= chunk; k += 1
+    workers = n_workers(args)
+    if workers > 1:
+        with Pool(processes=workers) as pool:
+            parts = pool.starmap(round_outcomes, jobs)
+    else:
+        parts = [round_outcomes(*job) for job in jobs]
+    outcomes = np.concatenate(parts)
+
+    r = simulate_sessions(outcomes, args.sessions, args.rounds, args.bankroll, args.bet,
+                          seed=args.seed, batch=args.batch)
+    qs = args.quantiles
+
+    os.makedirs(args.outdir, exist_ok=True)
+    out_csv = os.path.join(args.outdir, "bankroll_summary.csv")
+    with open(out_csv, "w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["metric","value"])
+        w.writerow(["decks", args.decks]); w.writerow(["policy", args.policy])
+        w.writerow(["sessions", r["sessions"]]); w.writerow(["rounds_per_session", args.rounds])
+        w.writerow(["start_bankroll", args.bankroll]); w.writerow(["bet", args.bet])
+        w.writerow(["pool_rounds", outcomes.size]); w.writerow(["pool_ev_per_round", f"{outcomes.mean():.6f}"])
+        w.writerow(["ruin_probability", f"{r['ruin_prob']:.6f}"])
+        w.writerow(["mean_rounds_to_ruin", f"{r['mean_rounds_to_ruin']:.3f}"])
+        w.writerow(["median_rounds_to_ruin", f"{float(r['ruin_times'].quantile(0.5)):.3f}"])
+        w.writerow(["mean_session_result", f"{r['mean_result']:.6f}"])
+        w.writerow(["sd_session_result", f"{r['sd_result']:.6f}"])
+        for q, v in zip(qs, r["results"].quantile(qs)):
+            w.writerow([f"q{100*q:g}_session_result", f"{v:.4f}"])
+    print(f"Saved bankroll summary to {out_csv}")
+
+    band_rows = np.array([b.quantile(qs) for b in r["bands"]])
+    band_df = pd.DataFrame(band_rows, columns=[f"q{100*q:g}" for q in qs])
+    band_df.insert(0, "round", r["checkpoints"])
+    band_csv = os.path.join(args.outdir, "bankroll_quantiles.csv")
+    band_df.to_csv(band_csv, index=False, float_format="%.4f")
+    print(f"Saved bankroll quantile bands to {band_csv}")
+
+    xs = np.r_[0, r["checkpoints"]]
+    ys = np.vstack([np.full(len(qs), float(args.bankroll)), band_rows])
+    plt.figure(figsize=(9,6))
+    for i in range(len(qs) // 2):
+        plt.fill_between(xs, ys[:, i], ys[:, -1-i], alpha=0.2,
+                         label=f"{100*qs[i]:g}–{100*qs[-1-i]:g}%")
+    if len(qs) % 2: plt.plot(xs, ys[:, len(qs)//2], label=f"{100*qs[len(qs)//2]:g}%", linewidth=2)
+    plt.axhline(args.bankroll, color="gray", linestyle="--", linewidth=1)
+    plt.xlabel("Round"); plt.ylabel("Bankroll (units)")
+    plt.title(f"Bankroll quantile bands (policy={args.policy}, decks={args.decks}, "
+              f"ruin={100*r['ruin_prob']:.2f}%)")
+    plt.grid(True, alpha=0.3); plt.legend(); plt.tight_layout()
+    plt.savefig(os.path.join(args.outdir, "bankroll_bands.png"), dpi=160); plt.close()
+
+    print("\n=== BANKROLL SESSIONS ===")
+    print(f"Sessions={r['sessions']:,} x {args.rounds} rounds | start={args.bankroll:g} bet={args.bet:g} | "
+          f"pool EV {outcomes.mean():+.4f}")
+    print(f"Ruin probability {100*r['ruin_prob']:.3f}%  |  mean rounds to ruin {r['mean_rounds_to_ruin']:.1f}")
+    print("Session result quantiles: " +
+          "  ".join(f"q{100*q:g}={v:+.1f}" for q, v in zip(qs, r["results"].quantile(qs))))
+
+# HAND HISTORY reader
+
+def history_cli(args):
+    """
+      - Memory-maps one or more hand-history logs
+      - Filters rounds by net result / action / flags and aggregates them
+      - Prints (and optionally re-plays) the first matching rounds; replay uses
+        the rules/policy stored in each log unless --rules-from-flags is given
+    """
+    n_all = n = 0; net_sum = wag_sum = 0.0; wins = draws = losses = 0
+    shown = replayed = mismatches = 0
+    for path in args.log:
+        meta, rec = load_history(path)
+        rules = rules_from_args(args) if args.rules_from_flags else Rules(**meta["rules"])
+        policy = args.policy or meta["policy"]
+        n_all += len(rec)
+        mask = np.ones(len(rec), dtype=bool)
+        if args.min_net is not None: mask &= rec["net"] >= args.min_net
+        if args.max_net is not None: mask &= rec["net"] <= args.max_net
+        if args.action: mask &= (rec["actions"] == _ACTION_CODE[args.action]).any(axis=1)
+        if args.flagged: mask &= rec["flags"] != 0
+        sel = rec[mask]
+        n += len(sel)
+        net_sum += float(sel["net"].sum(dtype=np.float64)); wag_sum += float(sel["wagered"].sum(dtype=np.float64))
+        wins += int((sel["net"] > 0).sum()); draws += int((sel["net"] == 0).sum()); losses += int((sel["net"] < 0).sum())
+        for r in sel[:max(0, args.show - shown)]:
+            line = describe_record(r)
+            if args.replay and r["flags"] & HIST_TRUNCATED:
+                line += "  replay=n/a"
+            elif args.replay:
+                net_r = replay_record(r, rules, policy)
+                ok = net_r is not None and math.isclose(net_r, float(r["net"]), abs_tol=1e-6)
+                replayed += 1; mismatches += not ok
+                line += ("  replay=cards do not fit" if net_r is None else f"  replay={net_r:+g}") + ("" if ok else "  MISMATCH")
+            print(line); shown += 1
+
+    print(f"\n=== HAND HISTORY ({len(args.log)} file(s)) ===")
+    print(f"Rounds matched: {n:,} of {n_all:,}")
+    if n:
+        print(f"EV per round {net_sum/n:+.4f}  |  wagered per round {wag_sum/n:.4f}  |  "
+              f"Win {100*wins/n:.2f}%  Draw {100*draws/n:.2f}%  Lose {100*losses/n:.2f}%")
+    if args.replay: print(f"Replay mismatches: {mismatches} of {replayed} replayed")
+
 # CLI
 
+def penetration_arg(text: str) -> float:
+    p = float(text)
+    if not 0 < p <= 1: raise argparse.ArgumentTypeError(f"penetration must be in (0, 1], got {text}")
+    return p
+
+def add_rule_args(ap: argparse.ArgumentParser):
+    """House-rule and shoe flags shared by the full-game subcommands."""
+    ap.add_argument("--s17", action="store_true", help="Dealer stands on soft 17 (default H17).")
+    ap.add_argument("--bj-payout", type=float, default=1.5)
+    ap.add_argument("--no-das", action="store_true", help="Disable Double After Split.")
+    ap.add_argument("--max-splits", type=int, default=3)
+    ap.add_argument("--hit-split-aces", action="store_true", help="Allow hitting split Aces (usually false).")
+    ap.add_argument("--double-9-to-11-only", action="store_true", help="If set, doubles only on 9–11 (not any two).")
+    ap.add_argument("--penetration", type=penetration_arg, default=None,
+                    help="Fraction of the shoe dealt before reshuffling (default: reshuffle with < 1 deck left).")
+    ap.add_argument("--csm", action="store_true", help="Continuous shuffling machine (discards returned every round).")
+
 def main():
     ap = argparse.ArgumentParser(description="Blackjack dataset + analysis + simulation (basic strategy supported)")
     sub = ap.add_subparsers(dest="cmd", required=True)
@@ -738,6 +1508,13 @@ def main():
     ap_d.add_argument("--seed", type=int, default=42)
     ap_d.add_argument("--s17", action="store_true", help="Dealer stands on soft 17 (default H17).")
     ap_d.add_argument("--out", default="blackjack_games.csv")
+    ap_d.add_argument("--rng", choices=["sequential","counter"], default="sequential",
+                      help="counter = Philox stream per game keyed by (seed, game_id).")
+    ap_d.add_argument("--stratified", action="store_true",
+                      help="Sample a fixed number of rows per (total, soft, upcard) cell, with weights.")
+    ap_d.add_argument("--per-cell", type=int, default=200, help="Rows per cell in --stratified mode.")
+    ap_d.add_argument("--pilot", type=int, default=200_000,
+                      help="Natural states walked to estimate cell frequencies in --stratified mode.")
 
     # analyze
     ap_a = sub.add_parser("analyze", help="Compute metrics and plots from the CSV.")
@@ -751,20 +1528,61 @@ def main():
     ap_s.add_argument("--n-games", type=int, default=200_000)
     ap_s.add_argument("--replicates", type=int, default=5)
     ap_s.add_argument("--seed", type=int, default=1234)
-    ap_s.add_argument("--s17", action="store_true", help="Dealer stands on soft 17 (default H17).")
-    ap_s.add_argument("--bj-payout", type=float, default=1.5)
-    ap_s.add_argument("--no-das", action="store_true", help="Disable Double After Split.")
-    ap_s.add_argument("--max-splits", type=int, default=3)
-    ap_s.add_argument("--hit-split-aces", action="store_true", help="Allow hitting split Aces (usually false).")
-    ap_s.add_argument("--double-9-to-11-only", action="store_true", help="If set, doubles only on 9–11 (not any two).")
+    add_rule_args(ap_s)
+    ap_s.add_argument("--state-stats", action="store_true",
+                      help="Accumulate per-decision-state EVs and write state_ev_table.csv.")
+    ap_s.add_argument("--rng", choices=["sequential","counter"], default="sequential",
+                      help="counter = Philox streams keyed by (seed, shoe index); work is split by shoes "
+                           "and results do not depend on --workers.")
+    ap_s.add_argument("--n-shoes", type=int, default=None,
+                      help="Shoes per replicate with --rng counter (default: enough for about --n-games rounds).")
+    ap_s.add_argument("--shoes-per-job", type=int, default=32, help="Shoes per worker job with --rng counter.")
+    ap_s.add_argument("--history", action="store_true",
+                      help="Log every round to binary hand-history files under <outdir>/history.")
     ap_s.add_argument("--workers", default="auto")
     ap_s.add_argument("--outdir", default="outputs")
 
+    # bankroll
+    ap_b = sub.add_parser("bankroll", help="Bankroll sessions: risk of ruin and session-result quantiles.")
+    ap_b.add_argument("--policy", choices=["naive","basic"], default="basic", help="Player policy.")
+    ap_b.add_argument("--decks", type=int, default=6)
+    ap_b.add_argument("--pool-rounds", type=int, default=200_000,
+                      help="Rounds played by the engine to build the per-round outcome pool.")
+    ap_b.add_argument("--sessions", type=int, default=1_000_000)
+    ap_b.add_argument("--rounds", type=int, default=200, help="Rounds per session.")
+    ap_b.add_argument("--bankroll", type=float, default=100.0, help="Starting bankroll (units).")
+    ap_b.add_argument("--bet", type=float, default=1.0, help="Flat bet per round (units).")
+    ap_b.add_argument("--quantiles", nargs="+", type=float, default=[0.05, 0.25, 0.5, 0.75, 0.95])
+    ap_b.add_argument("--batch", type=int, default=100_000, help="Sessions simulated per NumPy batch.")
+    ap_b.add_argument("--seed", type=int, default=1234)
+    add_rule_args(ap_b)
+    ap_b.add_argument("--workers", default="auto")
+    ap_b.add_argument("--outdir", default="outputs")
+
+    # history
+    ap_h = sub.add_parser("history", help="Filter / aggregate / replay binary hand-history logs.")
+    ap_h.add_argument("--log", nargs="+", required=True, help="Hand-history file(s) written by simulate --history.")
+    ap_h.add_argument("--min-net", type=float, default=None)
+    ap_h.add_argument("--max-net", type=float, default=None)
+    ap_h.add_argument("--action", choices=list(STATE_ACTIONS), default=None, help="Keep rounds where this action was taken.")
+    ap_h.add_argument("--flagged", action="store_true", help="Keep only reshuffled/truncated records.")
+    ap_h.add_argument("--show", type=int, default=10, help="Number of matching rounds to print.")
+    ap_h.add_argument("--replay", action="store_true", help="Re-play printed rounds and check the recorded net.")
+    ap_h.add_argument("--policy", choices=["naive","basic"], default=None,
+                      help="Policy for --replay (default: the one stored in the log).")
+    ap_h.add_argument("--rules-from-flags", action="store_true",
+                      help="Replay with the rule flags below instead of the rules stored in the log.")
+    add_rule_args(ap_h)
+
     args = ap.parse_args()
 
     if args.cmd == "dataset":
         os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
-        df = generate_dataset(n_rows=args.rows, seed=args.seed, s17=args.s17)
+        if args.stratified:
+            df = generate_dataset_stratified(per_cell=args.per_cell, seed=args.seed, s17=args.s17,
+                                             n_pilot=args.pilot, rng_mode=args.rng)
+        else:
+            df = generate_dataset(n_rows=args.rows, seed=args.seed, s17=args.s17, rng_mode=args.rng)
         df.to_csv(args.out, index=False)
         print(f"Wrote {len(df):,} rows to {args.out}")
 
@@ -774,5 +1592,11 @@ def main():
     elif args.cmd == "simulate":
         simulate_cli(args)
 
+    elif args.cmd == "bankroll":
+        bankroll_cli(args)
+
+    elif args.cmd == "history":
+        history_cli(args)
+
 if __name__ == "__main__":
     main()